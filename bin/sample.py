@@ -283,6 +283,11 @@ def build_parser() -> argparse.ArgumentParser:
     )
     parser.add_argument("--seed", type=int, default=SEED, help="Random seed")
     parser.add_argument("--device", type=str, default="cuda:0", help="Device to use")
+    parser.add_argument(
+        "--compile",
+        action="store_true",
+        help="Compile the model with torch.compile before sampling (requires torch>=2.0)",
+    )
     return parser
 
 
@@ -354,6 +359,7 @@ def main() -> None:
         n=args.num,
         sweep_lengths=(sweep_min_len, sweep_max_len),
         batch_size=args.batchsize,
+        compile_model=args.compile,
     )
     final_sampled = [s[-1] for s in sampled]
     sampled_dfs = [
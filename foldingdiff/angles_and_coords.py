@@ -24,6 +24,17 @@ MINIMAL_ANGLES = ["phi", "psi", "omega"]
 MINIMAL_DISTS = []
 
 
+def _backbone_indices(starts: np.ndarray, offsets: Tuple[int, ...]) -> np.ndarray:
+    """
+    Build the (len(starts) + 1, len(offsets)) array of backbone atom indices given
+    by adding each offset to each start. The last row is all zeros, as a null value
+    to pad measurements that are not defined at the end of the chain.
+    """
+    idx = np.zeros((len(starts) + 1, len(offsets)), dtype=int)
+    idx[:-1] = starts[:, np.newaxis] + np.array(offsets)
+    return idx
+
+
 def canonical_distances_and_dihedrals(
     fname: str,
     distances: List[str] = MINIMAL_DISTS,
@@ -57,22 +68,13 @@ def canonical_distances_and_dihedrals(
     for a in non_dihedral_angles:
         if a == "tau" or a == "N:CA:C":
             # tau = N - CA - C internal angles
-            idx = np.array(
-                [list(range(i, i + 3)) for i in range(3, len(backbone_atoms), 3)]
-                + [(0, 0, 0)]
-            )
+            idx = _backbone_indices(np.arange(3, len(backbone_atoms), 3), (0, 1, 2))
         elif a == "CA:C:1N":  # Same as C-N angle in nerf
             # This measures an angle between two residues. Due to the way we build
             # proteins out later, we do not need to meas
-            idx = np.array(
-                [(i + 1, i + 2, i + 3) for i in range(0, len(backbone_atoms) - 3, 3)]
-                + [(0, 0, 0)]
-            )
+            idx = _backbone_indices(np.arange(0, len(backbone_atoms) - 3, 3), (1, 2, 3))
         elif a == "C:1N:1CA":
-            idx = np.array(
-                [(i + 2, i + 3, i + 4) for i in range(0, len(backbone_atoms) - 3, 3)]
-                + [(0, 0, 0)]
-            )
+            idx = _backbone_indices(np.arange(0, len(backbone_atoms) - 3, 3), (2, 3, 4))
         else:
             raise ValueError(f"Unrecognized angle: {a}")
         calc_angles[a] = struc.index_angle(backbone_atoms, indices=idx)
@@ -89,31 +91,35 @@ def canonical_distances_and_dihedrals(
             # Since this is measuring the distance between pairs of residues, there
             # is one fewer such measurement than the total number of residues like
             # for dihedrals. Therefore, we pad this with a null 0 value at the end.
-            idx = np.array(
-                [(i + 2, i + 3) for i in range(0, len(backbone_atoms) - 3, 3)]
-                + [(0, 0)]
-            )
+            idx = _backbone_indices(np.arange(0, len(backbone_atoms) - 3, 3), (2, 3))
         elif d == "N:CA":
             # We start resconstructing with a fixed initial residue so we do not need
             # to predict or record the initial distance. Additionally we pad with a
             # null value at the end
-            idx = np.array(
-                [(i, i + 1) for i in range(3, len(backbone_atoms), 3)] + [(0, 0)]
-            )
+            idx = _backbone_indices(np.arange(3, len(backbone_atoms), 3), (0, 1))
             assert len(idx) == len(calc_angles["phi"])
         elif d == "CA:C":
             # We start reconstructing with a fixed initial residue so we do not need
             # to predict or record the initial distance. Additionally, we pad with a
             # null value at the end.
-            idx = np.array(
-                [(i + 1, i + 2) for i in range(3, len(backbone_atoms), 3)] + [(0, 0)]
-            )
+            idx = _backbone_indices(np.arange(3, len(backbone_atoms), 3), (1, 2))
             assert len(idx) == len(calc_angles["phi"])
         else:
             raise ValueError(f"Unrecognized distance: {d}")
         calc_angles[d] = struc.index_distance(backbone_atoms, indices=idx)
 
-    return pd.DataFrame({k: calc_angles[k].squeeze() for k in distances + angles})
+    # Write each measurement directly into one 2D buffer, which the DataFrame then
+    # wraps as a single block without copying
+    columns = distances + angles
+    if not columns:
+        return pd.DataFrame()
+    out = np.empty(
+        (len(calc_angles["phi"]), len(columns)),
+        dtype=np.result_type(*[calc_angles[k] for k in columns]),
+    )
+    for j, k in enumerate(columns):
+        out[:, j] = calc_angles[k].squeeze()
+    return pd.DataFrame(out, columns=columns, copy=False)
 
 
 def create_new_chain_nerf(
@@ -145,44 +151,47 @@ def create_new_chain_nerf(
     required_dihedrals = ["phi", "psi", "omega"]
     assert all([a in angles_to_set for a in required_dihedrals])
 
+    # Pull each column out as a plain array once, so that the builder does not have
+    # to go through pandas indexing
+    values = {c: dists_and_angles[c].to_numpy() for c in dists_and_angles.columns}
     nerf_build_kwargs = dict(
-        phi_dihedrals=dists_and_angles["phi"],
-        psi_dihedrals=dists_and_angles["psi"],
-        omega_dihedrals=dists_and_angles["omega"],
+        phi_dihedrals=values["phi"],
+        psi_dihedrals=values["psi"],
+        omega_dihedrals=values["omega"],
     )
     for a in angles_to_set:
         if a in required_dihedrals:
             continue
         assert a in dists_and_angles
         if a == "tau" or a == "N:CA:C":
-            nerf_build_kwargs["bond_angle_ca_c"] = dists_and_angles[a]
+            nerf_build_kwargs["bond_angle_ca_c"] = values[a]
         elif a == "CA:C:1N":
-            nerf_build_kwargs["bond_angle_c_n"] = dists_and_angles[a]
+            nerf_build_kwargs["bond_angle_c_n"] = values[a]
         elif a == "C:1N:1CA":
-            nerf_build_kwargs["bond_angle_n_ca"] = dists_and_angles[a]
+            nerf_build_kwargs["bond_angle_n_ca"] = values[a]
         else:
             raise ValueError(f"Unrecognized angle: {a}")
 
     for d in dists_to_set:
         assert d in dists_and_angles.columns
         if d == "0C:1N":
-            nerf_build_kwargs["bond_len_c_n"] = dists_and_angles[d]
+            nerf_build_kwargs["bond_len_c_n"] = values[d]
         elif d == "N:CA":
-            nerf_build_kwargs["bond_len_n_ca"] = dists_and_angles[d]
+            nerf_build_kwargs["bond_len_n_ca"] = values[d]
         elif d == "CA:C":
-            nerf_build_kwargs["bond_len_ca_c"] = dists_and_angles[d]
+            nerf_build_kwargs["bond_len_ca_c"] = values[d]
         else:
             raise ValueError(f"Unrecognized distance: {d}")
 
     nerf_builder = nerf.NERFBuilder(**nerf_build_kwargs)
-    coords = (
-        nerf_builder.centered_cartesian_coords
-        if center_coords
-        else nerf_builder.cartesian_coords
-    )
+    coords = nerf_builder.cartesian_coords
     if np.any(np.isnan(coords)):
         logging.warning(f"Found NaN values, not writing pdb file {out_fname}")
         return ""
+    if center_coords:
+        # The builder is discarded after this, so center its coordinates in place
+        # instead of keeping a second centered copy (see centered_cartesian_coords)
+        coords -= coords.mean(axis=0, keepdims=True)
 
     assert coords.shape == (
         int(dists_and_angles.shape[0] * 3),
@@ -198,54 +207,32 @@ def write_coords_to_pdb(coords: np.ndarray, out_fname: str) -> str:
     # Create a new PDB file using biotite
     # https://www.biotite-python.org/tutorial/target/index.html#creating-structures
     assert len(coords) % 3 == 0
-    atoms = []
-    for i, (n_coord, ca_coord, c_coord) in enumerate(
-        (coords[j : j + 3] for j in range(0, len(coords), 3))
-    ):
-        atom1 = struc.Atom(
-            n_coord,
-            chain_id="A",
-            res_id=i + 1,
-            atom_id=i * 3 + 1,
-            res_name="GLY",
-            atom_name="N",
-            element="N",
-            occupancy=1.0,
-            hetero=False,
-            b_factor=5.0,
-        )
-        atom2 = struc.Atom(
-            ca_coord,
-            chain_id="A",
-            res_id=i + 1,
-            atom_id=i * 3 + 2,
-            res_name="GLY",
-            atom_name="CA",
-            element="C",
-            occupancy=1.0,
-            hetero=False,
-            b_factor=5.0,
-        )
-        atom3 = struc.Atom(
-            c_coord,
-            chain_id="A",
-            res_id=i + 1,
-            atom_id=i * 3 + 3,
-            res_name="GLY",
-            atom_name="C",
-            element="C",
-            occupancy=1.0,
-            hetero=False,
-            b_factor=5.0,
-        )
-        atoms.extend([atom1, atom2, atom3])
-    full_structure = struc.array(atoms)
+    n_res = len(coords) // 3
+    full_structure = struc.AtomArray(len(coords))
+    full_structure.coord = coords
+    full_structure.chain_id[:] = "A"
+    full_structure.res_id = np.repeat(np.arange(1, n_res + 1), 3)
+    full_structure.res_name[:] = "GLY"
+    full_structure.atom_name = np.tile(["N", "CA", "C"], n_res)
+    full_structure.element = np.tile(["N", "C", "C"], n_res)
+    full_structure.hetero[:] = False
+    full_structure.set_annotation("atom_id", np.arange(1, len(coords) + 1))
+    full_structure.set_annotation("occupancy", np.full(len(coords), 1.0))
+    full_structure.set_annotation("b_factor", np.full(len(coords), 5.0))
 
-    # Add bonds
-    full_structure.bonds = struc.BondList(full_structure.array_length())
-    indices = list(range(full_structure.array_length()))
-    for a, b in zip(indices[:-1], indices[1:]):
-        full_structure.bonds.add_bond(a, b, bond_type=struc.BondType.SINGLE)
+    # Add bonds between each pair of consecutive atoms
+    indices = np.arange(full_structure.array_length())
+    full_structure.bonds = struc.BondList(
+        full_structure.array_length(),
+        np.stack(
+            [
+                indices[:-1],
+                indices[1:],
+                np.full(len(indices) - 1, struc.BondType.SINGLE),
+            ],
+            axis=-1,
+        ),
+    )
 
     # Annotate secondary structure using CA coordinates
     # https://www.biotite-python.org/apidoc/biotite.structure.annotate_sse.html
@@ -293,7 +280,6 @@ def extract_backbone_coords(
 
 if __name__ == "__main__":
     logging.basicConfig(level=logging.DEBUG)
-    # test_reverse_dihedral()
     print(
         extract_backbone_coords(
             os.path.join(os.path.dirname(os.path.dirname(__file__)), "data/1CRN.pdb")
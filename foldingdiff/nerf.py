@@ -14,6 +14,11 @@ from typing import *
 import numpy as np
 import torch
 
+try:
+    from foldingdiff import nerf_numba
+except ImportError:
+    nerf_numba = None
+
 N_CA_LENGTH = 1.46  # Check, approxiamtely right
 CA_C_LENGTH = 1.54  # Check, approximately right
 C_N_LENGTH = 1.34  # Check, approximately right
@@ -55,18 +60,6 @@ class NERFBuilder:
         self.psi = psi_dihedrals.squeeze()
         self.omega = omega_dihedrals.squeeze()
 
-        # We start with coordinates for N --> CA --> C so the next atom we add
-        # is the next N. Therefore, the first angle we need is the C --> N bond
-        self.bond_lengths = {
-            ("C", "N"): bond_len_c_n,
-            ("N", "CA"): bond_len_n_ca,
-            ("CA", "C"): bond_len_ca_c,
-        }
-        self.bond_angles = {
-            ("C", "N"): bond_angle_c_n,
-            ("N", "CA"): bond_angle_n_ca,
-            ("CA", "C"): bond_angle_ca_c,
-        }
         self.init_coords = [c.squeeze() for c in init_coords]
         assert (
             len(self.init_coords) == 3
@@ -75,13 +68,36 @@ class NERFBuilder:
             [c.size == 3 for c in self.init_coords]
         ), "Initial coords should be 3-dimensional"
 
+        self.device = None
+        if self.use_torch:
+            # Convert the initial coordinates once up front, on the same device as the
+            # dihedrals. These are constants so, unlike the dihedrals, they do not
+            # require gradients.
+            self.device = next(
+                v.device
+                for v in (self.phi, self.psi, self.omega)
+                if isinstance(v, torch.Tensor)
+            )
+            self.init_coords = [
+                torch.as_tensor(c, dtype=torch.float64, device=self.device)
+                for c in self.init_coords
+            ]
+
+        # We start with coordinates for N --> CA --> C so the next atom we add
+        # is the next N. Therefore, the first angle we need is the C --> N bond.
+        # Bond values are packed into (3, n) arrays of C-N, N-CA, CA-C values, where
+        # n is the number of residues placed after the initial one
+        n = self.phi.shape[0] - 1
+        self._bls = self._pack_bond_values(
+            [bond_len_c_n, bond_len_n_ca, bond_len_ca_c], n
+        )
+        self._bas = self._pack_bond_values(
+            [bond_angle_c_n, bond_angle_n_ca, bond_angle_ca_c], n
+        )
+
     @cached_property
     def cartesian_coords(self) -> Union[np.ndarray, torch.Tensor]:
         """Build out the molecule"""
-        retval = self.init_coords.copy()
-        if self.use_torch:
-            retval = [torch.tensor(x, requires_grad=True) for x in retval]
-
         # The first value of phi at the N terminus is not defined
         # The last value of psi and omega at the C terminus are not defined
         phi = self.phi[1:]
@@ -95,31 +111,59 @@ class NERFBuilder:
         assert (
             dih_angles.shape[1] == 3
         ), f"Unexpected dih_angles shape: {dih_angles.shape}"
+        n = dih_angles.shape[0]
+
+        # Procedure for placing N-CA-C
+        # Place the next N atom, which requires the C-N bond length/angle, and the psi dihedral
+        # Place the alpha carbon, which requires the N-CA bond length/angle, and the omega dihedral
+        # Place the carbon, which requires the the CA-C bond length/angle, and the phi dihedral
+        # All values are gathered up front and interleaved in this order, so that the
+        # kth entry describes the kth atom placed after the initial residue
+        torsions = dih_angles.reshape(-1)
+        bond_lengths = self._bls.T.reshape(-1)
+        bond_angles = self._bas.T.reshape(-1)
+        assert torsions.shape == bond_lengths.shape == bond_angles.shape == (3 * n,)
+
+        # The displacement of each atom in its local frame does not depend on the
+        # coordinates placed before it, so do all the trigonometry in one pass
+        d0, d1, d2 = _local_displacement(
+            bond_angles, bond_lengths, torsions, use_torch=self.use_torch
+        )
 
-        for i in range(dih_angles.shape[0]):
-            # for i, (phi, psi, omega) in enumerate(
-            #     zip(self.phi[1:], self.psi[:-1], self.omega[:-1])
-            # ):
-            dih = dih_angles[i]
-            # Procedure for placing N-CA-C
-            # Place the next N atom, which requires the C-N bond length/angle, and the psi dihedral
-            # Place the alpha carbon, which requires the N-CA bond length/angle, and the omega dihedral
-            # Place the carbon, which requires the the CA-C bond length/angle, and the phi dihedral
-            for j, bond in enumerate(self.bond_lengths.keys()):
-                coords = place_dihedral(
+        if self.use_torch:
+            # Writing each atom into a preallocated tensor would add an in-place copy
+            # to the autograd graph for every atom, so collect them and stack once
+            retval = list(self.init_coords)
+            for k in range(3 * n):
+                coords = _place_local_displacement(
                     retval[-3],
                     retval[-2],
                     retval[-1],
-                    bond_angle=self._get_bond_angle(bond, i),
-                    bond_length=self._get_bond_length(bond, i),
-                    torsion_angle=dih[j],
-                    use_torch=self.use_torch,
+                    d0[k],
+                    d1[k],
+                    d2[k],
+                    use_torch=True,
                 )
                 retval.append(coords)
-
-        if self.use_torch:
             return torch.stack(retval)
-        return np.array(retval)
+
+        # Coordinates are written into a single preallocated (3 + 3 * n, 3) buffer,
+        # starting with the initial N-CA-C residue; each atom is placed using the
+        # three rows before it
+        retval = np.empty((3 + 3 * n, 3), dtype=np.float64)
+        retval[:3] = self.init_coords
+        if nerf_numba is not None:
+            nerf_numba.build(
+                *[np.ascontiguousarray(x, dtype=np.float64) for x in (d0, d1, d2)],
+                retval,
+            )
+            return retval
+
+        for k in range(3 * n):
+            retval[k + 3] = _place_local_displacement(
+                retval[k], retval[k + 1], retval[k + 2], d0[k], d1[k], d2[k]
+            )
+        return retval
 
     @cached_property
     def centered_cartesian_coords(self) -> Union[np.ndarray, torch.Tensor]:
@@ -127,19 +171,27 @@ class NERFBuilder:
         means = self.cartesian_coords.mean(axis=0)
         return self.cartesian_coords - means
 
-    def _get_bond_length(self, bond: Tuple[str, str], idx: int):
-        """Get the ith bond distance"""
-        v = self.bond_lengths[bond]
-        if isinstance(v, float):
-            return v
-        return v[idx]
-
-    def _get_bond_angle(self, bond: Tuple[str, str], idx: int):
-        """Get the ith bond angle"""
-        v = self.bond_angles[bond]
-        if isinstance(v, float):
-            return v
-        return v[idx]
+    def _pack_bond_values(self, values, n: int):
+        """
+        Stack the first n of each of the given bond values into a (len(values), n)
+        array or tensor matching the active backend, broadcasting constant values
+        """
+        packed = []
+        for v in values:
+            if isinstance(v, float):
+                v = np.full(n, v)
+            elif not isinstance(v, torch.Tensor):
+                v = np.asarray(v)[:n]
+            else:
+                v = v[:n]
+            if self.use_torch and isinstance(v, torch.Tensor):
+                v = v.to(self.device)
+            elif self.use_torch:
+                # Copy numpy values so that the tensor owns its data, since v may be
+                # a read-only view into e.g. a DataFrame
+                v = torch.tensor(v, device=self.device)
+            packed.append(v)
+        return torch.stack(packed) if self.use_torch else np.stack(packed)
 
 
 def place_dihedral(
@@ -153,23 +205,72 @@ def place_dihedral(
 ) -> Union[np.ndarray, torch.Tensor]:
     """
     Place the point d such that the bond angle, length, and torsion angle are satisfied
-    with the series a, b, c, d.
+    with the series a, b, c, d. Also accepts a batch of points a, b, c of shape (M, 3),
+    in which case the bond angle, length, and torsion angle are given per point with
+    shape (M,) or (M, 1).
     """
     assert a.shape == b.shape == c.shape
     assert a.shape[-1] == b.shape[-1] == c.shape[-1] == 3
 
     if not use_torch:
-        unit_vec = lambda x: x / np.linalg.norm(x, axis=-1)
-        cross = lambda x, y: np.cross(x, y, axis=-1)
+        # Give the scalar values a trailing axis so they line up with the points
+        bond_angle, bond_length, torsion_angle = [
+            np.asarray(x)[..., np.newaxis] if np.ndim(x) < a.ndim else np.asarray(x)
+            for x in (bond_angle, bond_length, torsion_angle)
+        ]
     else:
-        ensure_tensor = (
-            lambda x: torch.tensor(x, requires_grad=False).to(a.device)
-            if not isinstance(x, torch.Tensor)
-            else x.to(a.device)
-        )
-        a, b, c, bond_angle, bond_length, torsion_angle = [
-            ensure_tensor(x) for x in (a, b, c, bond_angle, bond_length, torsion_angle)
+        # as_tensor is a no-op for inputs that are already tensors on the right device
+        a = torch.as_tensor(a)
+        b, c, bond_angle, bond_length, torsion_angle = [
+            torch.as_tensor(x, device=a.device)
+            for x in (b, c, bond_angle, bond_length, torsion_angle)
         ]
+        bond_angle, bond_length, torsion_angle = [
+            x.unsqueeze(-1) if x.ndim < a.ndim else x
+            for x in (bond_angle, bond_length, torsion_angle)
+        ]
+
+    d0, d1, d2 = _local_displacement(
+        bond_angle, bond_length, torsion_angle, use_torch=use_torch
+    )
+    return _place_local_displacement(a, b, c, d0, d1, d2, use_torch=use_torch)
+
+
+def _local_displacement(
+    bond_angle: Union[np.ndarray, torch.Tensor],
+    bond_length: Union[np.ndarray, torch.Tensor],
+    torsion_angle: Union[np.ndarray, torch.Tensor],
+    use_torch: bool = False,
+) -> Tuple[Union[np.ndarray, torch.Tensor], ...]:
+    """
+    Displacement of the point d from c in the local frame of a, b, c (see
+    _place_local_displacement), given as its components along bc, nbc, and n.
+    This is elementwise, so it can be evaluated for many points at once.
+    """
+    cos, sin = (torch.cos, torch.sin) if use_torch else (np.cos, np.sin)
+    sin_bond_angle = sin(bond_angle)
+    d0 = -bond_length * cos(bond_angle)
+    d1 = bond_length * cos(torsion_angle) * sin_bond_angle
+    d2 = bond_length * sin(torsion_angle) * sin_bond_angle
+    return d0, d1, d2
+
+
+def _place_local_displacement(
+    a: Union[np.ndarray, torch.Tensor],
+    b: Union[np.ndarray, torch.Tensor],
+    c: Union[np.ndarray, torch.Tensor],
+    d0: Union[np.ndarray, torch.Tensor],
+    d1: Union[np.ndarray, torch.Tensor],
+    d2: Union[np.ndarray, torch.Tensor],
+    use_torch: bool = False,
+) -> Union[np.ndarray, torch.Tensor]:
+    """
+    Place the point d given its displacement from c in the local frame of a, b, c
+    """
+    if not use_torch:
+        unit_vec = lambda x: x / np.linalg.norm(x, axis=-1, keepdims=True)
+        cross = lambda x, y: np.cross(x, y, axis=-1)
+    else:
         unit_vec = lambda x: x / torch.linalg.norm(x, dim=-1, keepdim=True)
         cross = lambda x, y: torch.linalg.cross(x, y, dim=-1)
 
@@ -178,30 +279,9 @@ def place_dihedral(
     n = unit_vec(cross(ab, bc))
     nbc = cross(n, bc)
 
-    if not use_torch:
-        m = np.stack([bc, nbc, n], axis=-1)
-        d = np.stack(
-            [
-                -bond_length * np.cos(bond_angle),
-                bond_length * np.cos(torsion_angle) * np.sin(bond_angle),
-                bond_length * np.sin(torsion_angle) * np.sin(bond_angle),
-            ],
-            axis=a.ndim - 1,
-        )
-        d = m.dot(d)
-    else:
-        m = torch.stack([bc, nbc, n], dim=-1)
-        d = torch.stack(
-            [
-                -bond_length * torch.cos(bond_angle),
-                bond_length * torch.cos(torsion_angle) * torch.sin(bond_angle),
-                bond_length * torch.sin(torsion_angle) * torch.sin(bond_angle),
-            ],
-            dim=a.ndim - 1,
-        ).type(m.dtype)
-        d = torch.matmul(m, d).squeeze()
-
-    return d + c
+    # Rotating the displacement into the global frame is a linear combination of
+    # the three unit vectors, so we never need to build the rotation matrix itself
+    return c + bc * d0 + nbc * d1 + n * d2
 
 
 def nerf_build_batch(
@@ -225,17 +305,16 @@ def nerf_build_batch(
     assert phi.shape == psi.shape == omega.shape
     batch = phi.shape[0]
 
-    # (batch, seq, 3)
-    coords = (
-        torch.tensor(np.array([N_INIT, CA_INIT, C_INIT]), requires_grad=True)
-        .repeat(batch, 1, 1)
-        .to(phi.device)
-    )
+    # (batch, seq, 3). The initial coordinates are deliberately float64 regardless
+    # of phi's dtype, so that atoms are placed and returned in float64 as before
+    coords = torch.as_tensor(
+        np.array([N_INIT, CA_INIT, C_INIT]), dtype=torch.float64, device=phi.device
+    ).repeat(batch, 1, 1)
     assert coords.shape == (batch, 3, 3), f"Mismatched shape: {coords.shape}"
 
     # perform broadcasting of bond lengths
     ensure_tensor = (
-        lambda x: torch.tensor(x, requires_grad=False).expand(phi.shape)
+        lambda x: torch.full(phi.shape, x, dtype=phi.dtype, device=phi.device)
         if isinstance(x, float)
         else x
     )
@@ -248,6 +327,37 @@ def nerf_build_batch(
     omega = omega[:, :-1]
     assert phi.shape == psi.shape == omega.shape
 
+    # When gradients are not needed, build the chains on CPU using numba instead,
+    # working on multiple chains in parallel
+    all_inputs = [
+        phi,
+        psi,
+        omega,
+        bond_angle_n_ca_c,
+        bond_angle_ca_c_n,
+        bond_angle_c_n_ca,
+        bond_len_n_ca,
+        bond_len_ca_c,
+        bond_len_c_n,
+    ]
+    needs_grad = torch.is_grad_enabled() and any(x.requires_grad for x in all_inputs)
+    if nerf_numba is not None and phi.device.type == "cpu" and not needs_grad:
+        n = phi.shape[1]
+        # Interleave values in the order atoms are placed (N, CA, C), as in
+        # NERFBuilder.cartesian_coords; shapes are (batch, 3 * n)
+        interleave = lambda *xs: np.stack(
+            [x[:, :n].detach().numpy().astype(np.float64) for x in xs], axis=-1
+        ).reshape(batch, 3 * n)
+        d0, d1, d2 = _local_displacement(
+            interleave(bond_angle_ca_c_n, bond_angle_c_n_ca, bond_angle_n_ca_c),
+            interleave(bond_len_c_n, bond_len_n_ca, bond_len_ca_c),
+            interleave(psi, omega, phi),
+        )
+        retval = np.empty((batch, 3 + 3 * n, 3), dtype=np.float64)
+        retval[:, :3] = coords.detach().cpu().numpy()
+        nerf_numba.build_batch(d0, d1, d2, retval)
+        return torch.from_numpy(retval)
+
     for i in range(phi.shape[1]):
         # Place the C-N
         n_coord = place_dihedral(
@@ -0,0 +1,71 @@
+"""
+Numba kernels for NERF, used by NERFBuilder for the numpy backend when numba
+is available. These mirror nerf._place_local_displacement, but work on scalars
+so that building a chain does not allocate any intermediate arrays.
+"""
+import math
+
+import numpy as np
+from numba import njit, prange
+
+# fastmath is deliberately left off: it allows numba to assume that no values
+# are NaN, and callers rely on NaN inputs propagating to NaN coordinates. For the
+# same reason, the numpy error model is used so that dividing by a zero norm gives
+# NaN/inf like numpy does, rather than raising ZeroDivisionError
+
+
+@njit(cache=True, error_model="numpy")
+def _place_local_displacement(ax, ay, az, bx, by, bz, cx, cy, cz, d0, d1, d2):
+    """
+    Place the point d given its displacement from c in the local frame of a, b, c.
+    Returns the coordinates of d as a tuple.
+    """
+    abx, aby, abz = bx - ax, by - ay, bz - az
+    bcx, bcy, bcz = cx - bx, cy - by, cz - bz
+    l = math.sqrt(bcx * bcx + bcy * bcy + bcz * bcz)
+    bcx, bcy, bcz = bcx / l, bcy / l, bcz / l
+
+    # n = unit(ab x bc)
+    nx = aby * bcz - abz * bcy
+    ny = abz * bcx - abx * bcz
+    nz = abx * bcy - aby * bcx
+    l = math.sqrt(nx * nx + ny * ny + nz * nz)
+    nx, ny, nz = nx / l, ny / l, nz / l
+
+    # nbc = n x bc
+    nbcx = ny * bcz - nz * bcy
+    nbcy = nz * bcx - nx * bcz
+    nbcz = nx * bcy - ny * bcx
+
+    return (
+        cx + bcx * d0 + nbcx * d1 + nx * d2,
+        cy + bcy * d0 + nbcy * d1 + ny * d2,
+        cz + bcz * d0 + nbcz * d1 + nz * d2,
+    )
+
+
+@njit(cache=True, error_model="numpy")
+def build(d0: np.ndarray, d1: np.ndarray, d2: np.ndarray, out: np.ndarray) -> None:
+    """
+    Build out the chain in place. out has shape (3 + len(d0), 3), with the first
+    three rows holding the initial N-CA-C coordinates. The kth displacement, given
+    by its components d0, d1, d2 in the local frame, is used to place the atom at
+    out[k + 3].
+    """
+    for k in range(d0.shape[0]):
+        a, b, c = out[k], out[k + 1], out[k + 2]
+        out[k + 3, 0], out[k + 3, 1], out[k + 3, 2] = _place_local_displacement(
+            a[0], a[1], a[2], b[0], b[1], b[2], c[0], c[1], c[2], d0[k], d1[k], d2[k]
+        )
+
+
+@njit(cache=True, parallel=True, error_model="numpy")
+def build_batch(
+    d0: np.ndarray, d1: np.ndarray, d2: np.ndarray, out: np.ndarray
+) -> None:
+    """
+    Build out a batch of chains in place, in parallel across the batch. d0, d1, d2
+    have shape (batch, n) and out has shape (batch, 3 + n, 3); see build.
+    """
+    for i in prange(d0.shape[0]):
+        build(d0[i], d1[i], d2[i], out[i])
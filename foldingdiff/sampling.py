@@ -24,38 +24,59 @@ from foldingdiff import beta_schedules, modelling, utils, sampling, tmalign
 from foldingdiff import angles_and_coords as ac
 
 
+def get_attn_mask(
+    seq_lens: Sequence[int], seq_len: int, device: torch.device
+) -> torch.Tensor:
+    """
+    Create the attention mask of shape (batch, seq_len) for the given lengths. 1
+    indicates positions to attend to, 0 indicates masked positions
+    """
+    lens = torch.as_tensor(seq_lens, device=device).reshape(-1)
+    return (torch.arange(seq_len, device=device)[None, :] < lens[:, None]).float()
+
+
 @torch.no_grad()
 def p_sample(
     model: nn.Module,
     x: torch.Tensor,
     t: torch.Tensor,
     seq_lens: Sequence[int],
-    t_index: torch.Tensor,
+    t_index: int,
     betas: torch.Tensor,
+    alpha_beta_values: Optional[Dict[str, torch.Tensor]] = None,
+    attn_mask: Optional[torch.Tensor] = None,
+    noise: Optional[torch.Tensor] = None,
 ) -> torch.Tensor:
     """
     Sample the given timestep. Note that this _may_ fall off the manifold if we just
     feed the output back into itself repeatedly, so we need to perform modulo on it
     (see p_sample_loop)
+
+    t_index is the timestep held by every entry of t, given separately as a plain int
+    so that selecting the schedule values does not need to read t back from the
+    device at every timestep.
+
+    alpha_beta_values are the outputs of beta_schedules.compute_alphas(betas); these
+    are constant across timesteps, so callers sampling many timesteps should compute
+    them once and pass them in. Similarly, attn_mask can be given to avoid
+    rebuilding it from seq_lens each timestep (see get_attn_mask), and noise can be
+    given to use pregenerated noise of the same shape as x instead of drawing it here.
     """
     # Calculate alphas and betas
-    alpha_beta_values = beta_schedules.compute_alphas(betas)
-    sqrt_recip_alphas = 1.0 / torch.sqrt(alpha_beta_values["alphas"])
+    if alpha_beta_values is None:
+        alpha_beta_values = beta_schedules.compute_alphas(betas)
 
     # Select based on time
-    t_unique = torch.unique(t)
-    assert len(t_unique) == 1, f"Got multiple values for t: {t_unique}"
-    t_index = t_unique.item()
-    sqrt_recip_alphas_t = sqrt_recip_alphas[t_index]
+    t_index = int(t_index)
+    sqrt_recip_alphas_t = 1.0 / torch.sqrt(alpha_beta_values["alphas"][t_index])
     betas_t = betas[t_index]
     sqrt_one_minus_alphas_cumprod_t = alpha_beta_values[
         "sqrt_one_minus_alphas_cumprod"
     ][t_index]
 
     # Create the attention mask
-    attn_mask = torch.zeros(x.shape[:2], device=x.device)
-    for i, l in enumerate(seq_lens):
-        attn_mask[i, :l] = 1.0
+    if attn_mask is None:
+        attn_mask = get_attn_mask(seq_lens, x.shape[1], x.device)
 
     # Equation 11 in the paper
     # Use our model (noise predictor) to predict the mean
@@ -70,11 +91,25 @@ def p_sample(
         return model_mean
     else:
         posterior_variance_t = alpha_beta_values["posterior_variance"][t_index]
-        noise = torch.randn_like(x)
+        if noise is None:
+            noise = torch.randn_like(x)
         # Algorithm 2 line 4:
         return model_mean + torch.sqrt(posterior_variance_t) * noise
 
 
+def compile_for_sampling(model: nn.Module) -> nn.Module:
+    """
+    Compile the model with torch.compile for use in the sampling loop, returning the
+    model unchanged if torch.compile is not available (requires torch >= 2.0)
+    """
+    if not hasattr(torch, "compile"):
+        logging.warning(
+            f"torch.compile is not available in torch {torch.__version__}, sampling without compilation"
+        )
+        return model
+    return torch.compile(model, mode="reduce-overhead", dynamic=False)
+
+
 @torch.no_grad()
 def p_sample_loop(
     model: nn.Module,
@@ -84,9 +119,22 @@ def p_sample_loop(
     betas: torch.Tensor,
     is_angle: Union[bool, List[bool]] = [False, True, True, True],
     disable_pbar: bool = False,
+    compile_model: bool = False,
+    noise_bank_steps: int = 100,
 ) -> torch.Tensor:
     """
     Returns a tensor of shape (timesteps, batch_size, seq_len, n_ft)
+
+    The noise added at each timestep is drawn noise_bank_steps timesteps at a time
+    with a single randn call, rather than once per timestep; this bounds the memory
+    used for the pregenerated noise to noise_bank_steps copies of the batch.
+
+    If compile_model is set, the model is compiled with torch.compile before sampling.
+    Every timestep runs the model on inputs of the same shape, so the compiled graph
+    (captured as a CUDA graph on GPU) is replayed for each step, which cuts Python
+    and kernel launch overhead. Requires torch >= 2.0. The model is wrapped anew on
+    each call; when sampling many batches, compile once with compile_for_sampling
+    and pass in the compiled model instead (see sample).
     """
     device = next(model.parameters()).device
     b = noise.shape[0]
@@ -97,14 +145,42 @@ def p_sample_loop(
         f"Starting from noise {noise.shape} with angularity {is_angle} and range {torch.amin(img, dim=(0, 1))} - {torch.amax(img, dim=(0, 1))} using {device}"
     )
 
-    imgs = []
+    # Move the schedule to the device once, so that each timestep indexes device
+    # tensors instead of copying scalars over from the host
+    betas = betas.to(device)
+    alpha_beta_values = beta_schedules.compute_alphas(betas)
+    attn_mask = get_attn_mask(lengths, img.shape[1], device)
+    # Boolean mask over the feature axis marking which features to wrap
+    if isinstance(is_angle, bool):
+        is_angle = [is_angle] * img.shape[-1]
+    assert len(is_angle) == img.shape[-1]
+    angle_mask = torch.tensor(is_angle, device=device, dtype=torch.bool)
+    wrap_angles = any(is_angle)
+
+    if compile_model:
+        model = compile_for_sampling(model)
+
+    # Preallocate the history on CPU, pinned if on GPU so that copying each step is
+    # asynchronous and overlaps with the subsequent model forward passes
+    imgs = torch.empty(
+        (timesteps, *img.shape), dtype=img.dtype, pin_memory=device.type == "cuda"
+    )
 
-    for i in tqdm(
-        reversed(range(0, timesteps)),
-        desc="sampling loop time step",
-        total=timesteps,
-        disable=disable_pbar,
+    assert noise_bank_steps > 0
+    for step, i in enumerate(
+        tqdm(
+            reversed(range(0, timesteps)),
+            desc="sampling loop time step",
+            total=timesteps,
+            disable=disable_pbar,
+        )
     ):
+        if step % noise_bank_steps == 0:
+            noise_bank = torch.randn(
+                (min(noise_bank_steps, timesteps - step), *img.shape),
+                device=device,
+                dtype=img.dtype,
+            )
         # Shape is (batch, seq_len, 4)
         img = p_sample(
             model=model,
@@ -113,23 +189,18 @@ def p_sample_loop(
             seq_lens=lengths,
             t_index=i,
             betas=betas,
+            alpha_beta_values=alpha_beta_values,
+            attn_mask=attn_mask,
+            noise=noise_bank[step % noise_bank_steps],
         )
 
         # Wrap if angular
-        if isinstance(is_angle, bool):
-            if is_angle:
-                img = utils.modulo_with_wrapped_range(
-                    img, range_min=-torch.pi, range_max=torch.pi
-                )
-        else:
-            assert len(is_angle) == img.shape[-1]
-            for j in range(img.shape[-1]):
-                if is_angle[j]:
-                    img[:, :, j] = utils.modulo_with_wrapped_range(
-                        img[:, :, j], range_min=-torch.pi, range_max=torch.pi
-                    )
-        imgs.append(img.cpu())
-    return torch.stack(imgs)
+        if wrap_angles:
+            img = torch.where(angle_mask, utils.wrap_to_pi(img), img)
+        imgs[timesteps - 1 - i].copy_(img, non_blocking=True)
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+    return imgs
 
 
 def sample(
@@ -140,6 +211,7 @@ def sample(
     batch_size: int = 512,
     feature_key: str = "angles",
     disable_pbar: bool = False,
+    compile_model: bool = False,
 ) -> List[np.ndarray]:
     """
     Sample from the given model. Use the train_dset to generate noise to sample
@@ -152,7 +224,10 @@ def sample(
     - alpha_beta_terms - provided by NoisedAnglesDataset
     - feature_is_angular - provided by *wrapped dataset* under NoisedAnglesDataset
     - pad - provided by *wrapped dataset* under NoisedAnglesDataset
-    And optionally, sample_length()
+    And optionally, sample_length(n)
+
+    If compile_model is set, the model is compiled once (see compile_for_sampling)
+    and the compiled model is used to sample every batch.
     """
     # Process each batch
     if sweep_lengths is not None:
@@ -164,12 +239,14 @@ def sample(
         for l in range(sweep_min, sweep_max):
             lengths.extend([l] * n)
     else:
-        lengths = [train_dset.sample_length() for _ in range(n)]
+        # Draw all the lengths at once; sample_length returns a scalar for n=1
+        lengths = np.atleast_1d(train_dset.sample_length(n)).tolist()
     lengths_chunkified = [
         lengths[i : i + batch_size] for i in range(0, len(lengths), batch_size)
     ]
 
     logging.info(f"Sampling {len(lengths)} items in batches of size {batch_size}")
+    sampling_model = compile_for_sampling(model) if compile_model else model
     retval = []
     for this_lengths in lengths_chunkified:
         batch = len(this_lengths)
@@ -179,7 +256,7 @@ def sample(
         )
         # Produces (timesteps, batch_size, seq_len, n_ft)
         sampled = p_sample_loop(
-            model=model,
+            model=sampling_model,
             lengths=this_lengths,
             noise=noise,
             timesteps=train_dset.timesteps,
@@ -284,6 +361,8 @@ def get_reconstruction_error(
     """
     device = next(model.parameters()).device
     model.eval()
+    # Move the schedule to the device once, as in p_sample_loop
+    alpha_beta_values = {k: v.to(device) for k, v in dset.alpha_beta_terms.items()}
 
     recont_angle_sets = []
     truth_angle_sets = []
@@ -300,6 +379,7 @@ def get_reconstruction_error(
         )
         img = batch["corrupted"].clone()
         assert img.ndim == 3
+        attn_mask = get_attn_mask(batch["lengths"], img.shape[1], device)
 
         # Record the actual files containing raw coordinates
         for i in idx_batch:
@@ -310,12 +390,14 @@ def get_reconstruction_error(
             img = sampling.p_sample(
                 model=model,
                 x=img,
-                t=torch.full((len(idx_batch),), fill_value=i, dtype=torch.long).to(
-                    device
+                t=torch.full(
+                    (len(idx_batch),), fill_value=i, dtype=torch.long, device=device
                 ),
                 seq_lens=batch["lengths"],
                 t_index=i,
-                betas=dset.alpha_beta_terms["betas"],
+                betas=alpha_beta_values["betas"],
+                alpha_beta_values=alpha_beta_values,
+                attn_mask=attn_mask,
             )
             img = utils.modulo_with_wrapped_range(img)
 
@@ -121,6 +121,21 @@ def modulo_with_wrapped_range(
     return retval
 
 
+def wrap_to_pi(vals):
+    """
+    Wrap angles into [-pi, pi] by subtracting the nearest multiple of 2pi. This is a
+    single branchless expression that matches
+    modulo_with_wrapped_range(vals, -np.pi, np.pi) up to float rounding, except
+    that values of exactly +/-pi are kept as is instead of being mapped to -pi.
+    Works on both numpy arrays and torch tensors.
+
+    >>> wrap_to_pi(np.array([4.0, -4.0, np.pi])).round(4)
+    array([-2.2832,  2.2832,  3.1416])
+    """
+    two_pi = 2 * np.pi
+    return vals - two_pi * (vals / two_pi).round()
+
+
 def update_dict_nonnull(d: Dict[str, Any], vals: Dict[str, Any]) -> Dict[str, Any]:
     """
     Update a dictionary with values from another dictionary.
@@ -27,6 +27,8 @@ setup(
         "biotite",
         "requests"
     ],
+    # numba is optional; without it NERF falls back to a much slower numpy loop
+    extras_require={"fast": ["numba>=0.56"]},
     classifiers=[
         "Programming Language :: Python :: 3",
         "Operating System :: OS Independent",
@@ -5,10 +5,13 @@ Unit tests for NERF conversion of internal coordinates to cartesian coordinates
 import os
 import tempfile
 import unittest
+from unittest import mock
+import warnings
 
 import numpy as np
 import torch
 from biotite.structure import dihedral
+from biotite.structure.io.pdb import PDBFile
 
 from foldingdiff import nerf
 from foldingdiff import angles_and_coords as ac
@@ -46,6 +49,17 @@ class TestDihedralPlacement(unittest.TestCase):
             )
             self.assertTrue(np.allclose(d, calc_d), f"Mismatched: {d} != {calc_d}")
 
+    def test_randomized_vectorized(self):
+        """Test random values for vectorized computation"""
+        a, b, c, d = self.rng.uniform(low=-5, high=5, size=(4, 100, 3))
+        angles = np.array([angle_between(*v) for v in zip(d - c, b - c)])
+        dists = np.array([dist_between(*v) for v in zip(c, d)])
+        dihedrals = np.array([dihedral(*v) for v in zip(a, b, c, d)])
+        calc_d = nerf.place_dihedral(a, b, c, angles, dists, dihedrals)
+        self.assertTrue(
+            np.allclose(d, calc_d, atol=1e-5), f"Mismatched: {d} != {calc_d}"
+        )
+
 
 class TestBackboneReconstruction(unittest.TestCase):
     """
@@ -241,6 +255,202 @@ class TestBackboneReconstruction(unittest.TestCase):
                 self.assertGreater(score, 0.95)
 
 
+class TestCanonicalDistancesAndDihedrals(unittest.TestCase):
+    """
+    Test reading angles and distances from a structure
+    """
+
+    def setUp(self) -> None:
+        self.pdb_file = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data/1CRN.pdb"
+        )
+        assert os.path.isfile(self.pdb_file)
+
+    def test_columns(self):
+        """Test that the requested columns are returned in order"""
+        df = ac.canonical_distances_and_dihedrals(
+            self.pdb_file, distances=ac.EXHAUSTIVE_DISTS, angles=ac.EXHAUSTIVE_ANGLES
+        )
+        self.assertEqual(list(df.columns), ac.EXHAUSTIVE_DISTS + ac.EXHAUSTIVE_ANGLES)
+        self.assertEqual(df.shape, (46, 9))
+        self.assertTrue(all(df.dtypes == np.float32))
+
+    def test_empty(self):
+        """Test that requesting no values gives an empty DataFrame"""
+        df = ac.canonical_distances_and_dihedrals(
+            self.pdb_file, distances=[], angles=[]
+        )
+        self.assertEqual(df.shape, (0, 0))
+
+
+class TestWriteCoordsToPdb(unittest.TestCase):
+    """
+    Test writing backbone coordinates to a PDB file
+    """
+
+    def setUp(self) -> None:
+        pdb_file = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data/1CRN.pdb"
+        )
+        angles = ac.canonical_distances_and_dihedrals(pdb_file)
+        self.coords = nerf.NERFBuilder(
+            angles["phi"].values, angles["psi"].values, angles["omega"].values
+        ).cartesian_coords
+        self.n_res = len(angles)
+
+    def test_read_back(self):
+        """Test that the written structure reads back with the expected contents"""
+        with tempfile.TemporaryDirectory() as tmpdir:
+            out_fname = ac.write_coords_to_pdb(
+                self.coords, os.path.join(tmpdir, "out.pdb")
+            )
+            structure = PDBFile.read(out_fname).get_structure(
+                model=1,
+                include_bonds=True,
+                extra_fields=["atom_id", "occupancy", "b_factor"],
+            )
+
+        self.assertEqual(structure.array_length(), self.n_res * 3)
+        self.assertTrue(
+            np.array_equal(structure.res_id, np.repeat(np.arange(1, self.n_res + 1), 3))
+        )
+        self.assertEqual(list(structure.atom_name), ["N", "CA", "C"] * self.n_res)
+        self.assertEqual(list(structure.element), ["N", "C", "C"] * self.n_res)
+        self.assertTrue(np.all(structure.res_name == "GLY"))
+        self.assertTrue(np.all(structure.chain_id == "A"))
+        self.assertTrue(
+            np.array_equal(structure.atom_id, np.arange(1, self.n_res * 3 + 1))
+        )
+        self.assertTrue(np.all(structure.occupancy == 1.0))
+        self.assertTrue(np.all(structure.b_factor == 5.0))
+        # PDB files store coordinates to 3 decimal places
+        self.assertTrue(np.allclose(structure.coord, self.coords, atol=1e-3))
+
+        # Each atom is bonded to the next one and to no others
+        bonds = structure.bonds.as_array()[:, :2]
+        bonds = sorted(tuple(sorted(b)) for b in bonds.tolist())
+        self.assertEqual(bonds, [(i, i + 1) for i in range(self.n_res * 3 - 1)])
+
+
+@unittest.skipIf(nerf.nerf_numba is None, "numba is not installed")
+class TestNumbaBackend(unittest.TestCase):
+    """
+    Test that the numba kernel matches the pure numpy implementation
+    """
+
+    def setUp(self) -> None:
+        self.pdb_file = os.path.join(
+            os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "data/7PFL.pdb"
+        )
+        assert os.path.isfile(self.pdb_file)
+
+    def test_matches_numpy(self):
+        """Test that both backends build the same coordinates"""
+        angles = ac.canonical_distances_and_dihedrals(
+            self.pdb_file,
+            distances=["0C:1N", "N:CA", "CA:C"],
+            angles=["phi", "psi", "omega", "tau", "CA:C:1N", "C:1N:1CA"],
+        ).astype(np.float64)
+        kwargs = dict(
+            phi_dihedrals=angles["phi"].values,
+            psi_dihedrals=angles["psi"].values,
+            omega_dihedrals=angles["omega"].values,
+            bond_angle_ca_c=angles["tau"].values,
+            bond_angle_c_n=angles["CA:C:1N"].values,
+            bond_angle_n_ca=angles["C:1N:1CA"].values,
+            bond_len_c_n=angles["0C:1N"].values,
+            bond_len_n_ca=angles["N:CA"].values,
+            bond_len_ca_c=angles["CA:C"].values,
+        )
+        numba_coords = nerf.NERFBuilder(**kwargs).cartesian_coords
+
+        with mock.patch.object(nerf, "nerf_numba", None):
+            numpy_coords = nerf.NERFBuilder(**kwargs).cartesian_coords
+
+        self.assertEqual(numba_coords.shape, (len(angles) * 3, 3))
+        self.assertTrue(np.allclose(numba_coords, numpy_coords, atol=1e-6))
+
+    def test_nan_propagation(self):
+        """Test that NaN values are propagated rather than ignored"""
+        rng = np.random.default_rng(seed=6489)
+        phi, psi, omega = rng.uniform(low=-np.pi, high=np.pi, size=(3, 20))
+        psi[5] = np.nan
+        coords = nerf.NERFBuilder(phi, psi, omega).cartesian_coords
+        self.assertFalse(np.any(np.isnan(coords[:18])))
+        self.assertTrue(np.all(np.isnan(coords[18:])))
+
+    def test_zero_bond_length(self):
+        """Test that a zero bond length gives the same NaN rows as numpy"""
+        rng = np.random.default_rng(seed=6489)
+        phi, psi, omega = rng.uniform(low=-np.pi, high=np.pi, size=(3, 20))
+        bl = np.full(20, nerf.C_N_LENGTH)
+        bl[4] = 0.0
+        numba_coords = nerf.NERFBuilder(
+            phi, psi, omega, bond_len_c_n=bl
+        ).cartesian_coords
+
+        with mock.patch.object(nerf, "nerf_numba", None):
+            numpy_coords = nerf.NERFBuilder(
+                phi, psi, omega, bond_len_c_n=bl
+            ).cartesian_coords
+
+        self.assertTrue(np.any(np.isnan(numpy_coords)))
+        self.assertTrue(np.array_equal(np.isnan(numba_coords), np.isnan(numpy_coords)))
+        self.assertTrue(np.allclose(numba_coords, numpy_coords, equal_nan=True))
+
+    def test_batch_zero_bond_length(self):
+        """Test that a zero bond length gives NaN rows in the batched build"""
+        rng = np.random.default_rng(seed=6489)
+        phi, psi, omega, tau, ca_c_1n, c_1n_1ca = [
+            torch.from_numpy(x)
+            for x in rng.uniform(low=-np.pi, high=np.pi, size=(6, 2, 20))
+        ]
+        bl = torch.full((2, 19), nerf.C_N_LENGTH, dtype=torch.float64)
+        bl[0, 4] = 0.0
+        with torch.no_grad():
+            numba_coords = nerf.nerf_build_batch(
+                phi, psi, omega, tau, ca_c_1n, c_1n_1ca, bond_len_c_n=bl
+            )
+        torch_coords = nerf.nerf_build_batch(
+            phi.requires_grad_(True),
+            psi,
+            omega,
+            tau,
+            ca_c_1n,
+            c_1n_1ca,
+            bond_len_c_n=bl,
+        ).detach()
+        self.assertTrue(torch.any(torch.isnan(torch_coords[0])))
+        self.assertFalse(torch.any(torch.isnan(torch_coords[1])))
+        self.assertTrue(
+            torch.equal(torch.isnan(numba_coords), torch.isnan(torch_coords))
+        )
+        self.assertTrue(
+            torch.allclose(numba_coords, torch_coords, atol=1e-4, equal_nan=True)
+        )
+
+    def test_batch_matches_pytorch(self):
+        """Test that building a batch without gradients matches the pytorch path"""
+        angles = ac.canonical_distances_and_dihedrals(
+            self.pdb_file,
+            distances=[],
+            angles=["phi", "psi", "omega", "tau", "CA:C:1N", "C:1N:1CA"],
+        )
+        phi, psi, omega, tau, ca_c_1n, c_1n_1ca = [
+            torch.from_numpy(angles[c].values).unsqueeze(0).repeat(4, 1)
+            for c in angles.columns
+        ]
+        with torch.no_grad():
+            numba_coords = nerf.nerf_build_batch(
+                phi, psi, omega, tau, ca_c_1n, c_1n_1ca
+            )
+        torch_coords = nerf.nerf_build_batch(
+            phi.requires_grad_(True), psi, omega, tau, ca_c_1n, c_1n_1ca
+        )
+        self.assertEqual(numba_coords.shape, torch_coords.shape)
+        self.assertTrue(torch.allclose(numba_coords, torch_coords.detach(), atol=1e-4))
+
+
 class TestPytorchBackend(unittest.TestCase):
     """
     Test that PyTorch backend should work
@@ -331,6 +541,20 @@ class TestPytorchBackend(unittest.TestCase):
             torch.allclose(d, calc_d, atol=1e-6), f"Mismatched: {d} != {calc_d}"
         )
 
+    def test_readonly_bond_values(self):
+        """Test that read-only numpy bond values are copied into owned tensors"""
+        phi, psi, omega = torch.from_numpy(
+            self.rng.uniform(low=-np.pi, high=np.pi, size=(3, 20))
+        )
+        bl = np.full(20, nerf.C_N_LENGTH)
+        bl.flags.writeable = False
+        with warnings.catch_warnings():
+            warnings.simplefilter("error", UserWarning)
+            builder = nerf.NERFBuilder(phi, psi, omega, bond_len_c_n=bl)
+        self.assertFalse(np.shares_memory(builder._bls.numpy(), bl))
+        ref = nerf.NERFBuilder(phi, psi, omega).cartesian_coords
+        self.assertTrue(torch.allclose(builder.cartesian_coords, ref))
+
 
 def angle_between(v1, v2) -> float:
     """Gets the angle between u and v"""
@@ -7,8 +7,11 @@ import unittest
 
 import numpy as np
 import torch
+from torch import nn
 
 from foldingdiff import sampling
+from foldingdiff import beta_schedules
+from foldingdiff import utils
 
 
 class TestSamplingReproducible(unittest.TestCase):
@@ -45,3 +48,121 @@ class TestSamplingReproducible(unittest.TestCase):
             self.full_model, n=1, sweep_lengths=[50, 51]
         ).pop()
         self.assertFalse(np.allclose(samp_1.values, samp_2.values))
+
+
+class TestAttnMask(unittest.TestCase):
+    """
+    Test creation of attention masks from lengths
+    """
+
+    def test_simple(self):
+        """Test that the mask matches a mask built one item at a time"""
+        lengths = [3, 1, 5, 0]
+        expected = torch.zeros((len(lengths), 5))
+        for i, l in enumerate(lengths):
+            expected[i, :l] = 1.0
+        attn_mask = sampling.get_attn_mask(lengths, 5, torch.device("cpu"))
+        self.assertTrue(torch.equal(attn_mask, expected))
+
+    def test_tensor_lengths(self):
+        """Test that lengths given as a (batch, 1) tensor are handled"""
+        attn_mask = sampling.get_attn_mask(
+            torch.tensor([[2], [4]]), 4, torch.device("cpu")
+        )
+        self.assertTrue(
+            torch.equal(attn_mask, torch.tensor([[1.0, 1.0, 0.0, 0.0], [1.0] * 4]))
+        )
+
+
+class StubModel(nn.Module):
+    """Small deterministic stand-in for the denoising model"""
+
+    def __init__(self, n_inputs: int = 4):
+        super().__init__()
+        self.n_inputs = n_inputs
+        self.linear = nn.Linear(n_inputs, n_inputs)
+        nn.init.constant_(self.linear.weight, 0.1)
+        nn.init.constant_(self.linear.bias, 0.0)
+
+    def forward(self, x, t, attention_mask=None):
+        out = torch.tanh(self.linear(x) + t[:, None, None] / 100.0)
+        return out * attention_mask[..., None]
+
+
+class TestSampleLoop(unittest.TestCase):
+    """
+    Test the sampling loop offline with a stub model
+    """
+
+    def setUp(self) -> None:
+        self.model = StubModel().eval()
+        self.timesteps = 23
+        self.betas = beta_schedules.cosine_beta_schedule(self.timesteps)
+        self.lengths = [5, 9, 7]
+        self.is_angle = [False, True, True, True]
+        self.noise = torch.randn((len(self.lengths), 10, 4))
+
+    def sample(self, seed: int = 1234, **kwargs) -> torch.Tensor:
+        """Run the sampling loop from a fixed seed"""
+        torch.manual_seed(seed)
+        return sampling.p_sample_loop(
+            self.model,
+            self.lengths,
+            self.noise.clone(),
+            self.timesteps,
+            self.betas,
+            is_angle=self.is_angle,
+            disable_pbar=True,
+            **kwargs,
+        )
+
+    def test_shape(self):
+        """Test that the full history is returned"""
+        imgs = self.sample(noise_bank_steps=5)
+        self.assertEqual(imgs.shape, (self.timesteps, *self.noise.shape))
+        self.assertTrue(torch.all(torch.isfinite(imgs)))
+        self.assertTrue(torch.all(torch.abs(imgs[..., 1:]) <= np.pi))
+
+    def test_reproducible(self):
+        """Test reproducibility when timesteps is not a multiple of the bank size"""
+        assert self.timesteps % 5 != 0
+        self.assertTrue(
+            torch.equal(
+                self.sample(noise_bank_steps=5), self.sample(noise_bank_steps=5)
+            )
+        )
+        self.assertFalse(
+            torch.equal(
+                self.sample(noise_bank_steps=5),
+                self.sample(seed=4321, noise_bank_steps=5),
+            )
+        )
+
+    def test_single_step_bank(self):
+        """Test that a bank of one step matches drawing noise in each p_sample"""
+        imgs = self.sample(noise_bank_steps=1)
+
+        torch.manual_seed(1234)
+        img = self.noise.clone()
+        angle_mask = torch.tensor(self.is_angle)
+        expected = []
+        for i in reversed(range(self.timesteps)):
+            img = sampling.p_sample(
+                self.model,
+                img,
+                torch.full((len(self.lengths),), i, dtype=torch.long),
+                self.lengths,
+                i,
+                self.betas,
+            )
+            img = torch.where(angle_mask, utils.wrap_to_pi(img), img)
+            expected.append(img)
+        self.assertTrue(torch.equal(imgs, torch.stack(expected)))
+
+    @unittest.skipIf(not hasattr(torch, "compile"), "torch.compile is not available")
+    def test_compile_model(self):
+        """Test that sampling with a compiled model matches the uncompiled model"""
+        imgs = self.sample(noise_bank_steps=5)
+        compiled_imgs = self.sample(noise_bank_steps=5, compile_model=True)
+        self.assertEqual(compiled_imgs.shape, imgs.shape)
+        self.assertTrue(torch.allclose(compiled_imgs, imgs, atol=1e-4))
@@ -1,6 +1,7 @@
 import unittest
 
 import numpy as np
+import torch
 
 from foldingdiff import utils
 
@@ -54,6 +55,73 @@ class TestModuloWithWrappedRange(unittest.TestCase):
         self.assertTrue(np.allclose(np.array([1, 1]), x))
 
 
+class TestWrapToPi(unittest.TestCase):
+    """Test the round-based wrap against modulo with wrapped range"""
+
+    def assert_matches_modulo(self, x, atol: float):
+        """
+        Check that wrap_to_pi matches modulo_with_wrapped_range up to rounding,
+        allowing values on the +/-pi boundary to land on either end of the range
+        """
+        wrapped = utils.wrap_to_pi(x)
+        expected = utils.modulo_with_wrapped_range(x, -np.pi, np.pi)
+        self.assertTrue(torch.all(wrapped >= -np.pi - atol))
+        self.assertTrue(torch.all(wrapped <= np.pi + atol))
+        diff = torch.abs(wrapped - expected)
+        diff = torch.minimum(diff, 2 * np.pi - diff)
+        self.assertLess(diff.max().item(), atol)
+
+    def test_large_magnitude(self):
+        """Test values spanning many multiples of 2pi"""
+        rng = np.random.default_rng(seed=6489)
+        x = torch.from_numpy(rng.uniform(-1000, 1000, size=10000))
+        self.assert_matches_modulo(x, atol=1e-9)
+
+    def test_large_magnitude_float32(self):
+        """Test float32 values at magnitudes seen at the start of sampling"""
+        rng = np.random.default_rng(seed=6489)
+        x = torch.from_numpy(rng.uniform(-50, 50, size=10000)).float()
+        self.assert_matches_modulo(x, atol=1e-4)
+
+    def test_pi_boundary(self):
+        """Test that values of exactly +/-pi are kept as is"""
+        x = torch.tensor([np.pi, -np.pi, 3 * np.pi, -3 * np.pi], dtype=torch.float64)
+        wrapped = utils.wrap_to_pi(x)
+        self.assertTrue(torch.allclose(wrapped[:2], x[:2]))
+        self.assertTrue(torch.allclose(torch.abs(wrapped[2:]), x[:1]))
+
+    def test_nan(self):
+        """Test that NaN values stay NaN"""
+        x = torch.tensor([np.nan, 4.0, np.nan])
+        wrapped = utils.wrap_to_pi(x)
+        self.assertTrue(torch.equal(torch.isnan(wrapped), torch.isnan(x)))
+        self.assertAlmostEqual(wrapped[1].item(), 4.0 - 2 * np.pi, places=5)
+
+    def test_partial_mask(self):
+        """Test wrapping only the masked features, as done during sampling"""
+        rng = np.random.default_rng(seed=6489)
+        x = torch.from_numpy(rng.uniform(-20, 20, size=(4, 10, 4)))
+        x[0, 0] = np.nan
+        angle_mask = torch.tensor([False, True, True, True])
+        wrapped = torch.where(angle_mask, utils.wrap_to_pi(x), x)
+        expected = torch.where(
+            angle_mask, utils.modulo_with_wrapped_range(x, -np.pi, np.pi), x
+        )
+        # The unmasked feature is left as is, including values outside [-pi, pi]
+        self.assertTrue(torch.allclose(wrapped[..., 0], x[..., 0], equal_nan=True))
+        self.assertTrue(torch.any(torch.abs(wrapped[..., 0]) > np.pi))
+        self.assertTrue(torch.allclose(wrapped, expected, atol=1e-9, equal_nan=True))
+
+    def test_numpy(self):
+        """Test that numpy arrays are supported"""
+        x = np.array([4.0, -4.0, 7.0])
+        self.assertTrue(
+            np.allclose(
+                utils.wrap_to_pi(x), utils.modulo_with_wrapped_range(x, -np.pi, np.pi)
+            )
+        )
+
+
 class TestTolerantComparison(unittest.TestCase):
     """Test code that does numeric comparisons that are tolerant of float wonkiness"""
 